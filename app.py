@@ -1,59 +1,246 @@
+import hashlib
 import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import random
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache
+import orjson
 from flask import Flask, jsonify, request
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-import re # For parsing competing products
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON provider that serializes with orjson's C encoder instead of the stdlib json module.
+    Keys stay sorted to match Flask's default output; anything orjson can't handle falls back to Flask's default().
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 # Initialize Flask App
 app = Flask(__name__)
+app.json = OrjsonProvider(app) # Use orjson for jsonify()
 CORS(app) # Enable CORS for all routes
 
 # Global variable to hold the loaded niche data
 niche_data_df = None
+# Precomputed low competition pools per category (plus 'all'), built once by load_data()
+niche_pools = {}
+# Identifies the loaded data version (CSV name, size and modification time) for response ETags, set by load_data()
+data_version = ''
+# (ISO week number, local time that week ends) cached by get_current_week(); kept as one tuple so it updates atomically
+current_week_cache = None
 CSV_FILE_NAME = 'US_AMAZON_magnet__2025-06-05.csv' # Make sure this matches your uploaded CSV name
+# Bump PARQUET_CACHE_VERSION whenever the preprocessing in load_data() changes, so older caches are ignored
+PARQUET_CACHE_VERSION = 1
+PARQUET_CACHE_FILE_NAME = f'niches.v{PARQUET_CACHE_VERSION}.parquet' # Preprocessed copy of the CSV, rebuilt whenever the CSV changes
+PARQUET_CACHE_SOURCE_KEY = b'niche_hunter.source_csv' # Parquet schema metadata key recording which CSV the cache was built from
+REQUIRED_COLUMNS = ['Keyword Phrase', 'Search Volume', 'Competing Products', 'category'] # Only these CSV columns are read
+STRING_COLUMNS = [col for col in REQUIRED_COLUMNS if col != 'Search Volume'] # Read as Arrow-backed strings
+MISSING_VALUE_MARKERS = ['', 'N/A', 'n/a'] # Cell values treated as missing
+CACHE_COLUMNS = ['name', 'search_volume_numeric', 'amazon_results', 'searchVolumeText', 'category']
+
+def get_csv_source_info():
+    """
+    Identifies the current CSV file by name, size and modification time.
+    """
+    stat = os.stat(CSV_FILE_NAME)
+    return {'file_name': CSV_FILE_NAME, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def is_parquet_cache_fresh(source_info):
+    """
+    Returns True if the Parquet cache exists and was built from exactly this CSV (same name, size and mtime).
+    Comparing for equality rather than "cache is newer" catches exports that arrive with an older, preserved mtime.
+    """
+    if not os.path.exists(PARQUET_CACHE_FILE_NAME):
+        return False
+    try:
+        metadata = pq.read_schema(PARQUET_CACHE_FILE_NAME).metadata or {}
+        return orjson.loads(metadata.get(PARQUET_CACHE_SOURCE_KEY, b'null')) == source_info
+    except Exception as e:
+        print(f"Warning: Could not read data cache metadata from '{PARQUET_CACHE_FILE_NAME}': {e}")
+        return False
 
-def parse_competing_products(value):
+def write_parquet_cache(df, source_info):
     """
-    Cleans and converts the 'Competing Products' column to a numeric type.
-    Handles strings like ">1,000" or "826".
+    Persists the preprocessed DataFrame so later startups can skip CSV parsing,
+    recording the CSV it was built from in the Parquet schema metadata.
+    Writes to a temporary file first so concurrent workers never read a partial cache.
     """
-    if pd.isna(value):
-        return 0 # Treat missing values as 0 or some other indicator of no data
-    s = str(value).replace(',', '').replace('>', '').strip()
-    if s.lower() == 'n/a' or not s:
-        return 0
+    tmp_file_name = f"{PARQUET_CACHE_FILE_NAME}.{os.getpid()}.tmp"
     try:
-        return int(s)
-    except ValueError:
-        return 0 # Or handle error appropriately, e.g., by logging
+        table = pa.Table.from_pandas(df[CACHE_COLUMNS], preserve_index=False)
+        metadata = {**(table.schema.metadata or {}), PARQUET_CACHE_SOURCE_KEY: orjson.dumps(source_info)}
+        pq.write_table(table.replace_schema_metadata(metadata), tmp_file_name, compression='snappy')
+        os.replace(tmp_file_name, PARQUET_CACHE_FILE_NAME)
+        print(f"Wrote preprocessed data cache to {PARQUET_CACHE_FILE_NAME}.")
+    except Exception as e:
+        print(f"Warning: Could not write data cache '{PARQUET_CACHE_FILE_NAME}': {e}")
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+
+def build_niche_pools(df):
+    """
+    Splits the data into the ultra-low (<500 results) and medium-low (500-999 results)
+    competition pools for every category, plus 'all', so requests only need a dict lookup.
+    Each pool is sorted by search volume descending, then by name, giving a stable order for weekly rotation,
+    and holds JSON-ready niche dicts so requests never touch the DataFrame.
+    """
+    # Drop high competition rows (1000+ results) in a single filtering pass so only candidates get sorted
+    low_comp_df = df.query('amazon_results < 1000').sort_values(by=['search_volume_numeric', 'name'], ascending=[False, True])
+    is_ultra_low = low_comp_df['amazon_results'].to_numpy() < 500
+
+    # Build the output dicts once; the 'all' and per-category pools reference the same dicts rather than copying them.
+    # Missing keywords and categories become None (JSON null) rather than pd.NA, which can't be serialized
+    records = [
+        {'name': None if pd.isna(name) else name, 'searchVolumeText': search_volume_text, 'amazonResults': amazon_results, 'category': None if pd.isna(category) else category}
+        for name, search_volume_text, amazon_results, category in zip(
+            low_comp_df['name'].tolist(),
+            low_comp_df['searchVolumeText'].tolist(),
+            low_comp_df['amazon_results'].tolist(),
+            low_comp_df['category'].tolist()
+        )
+    ]
+
+    def split_by_competition(positions):
+        # Positions are in search volume order, so both pools keep that order
+        ultra_low_mask = is_ultra_low[positions]
+        return (
+            [records[i] for i in positions[ultra_low_mask]],
+            [records[i] for i in positions[~ultra_low_mask]]
+        )
+
+    # Every category gets an entry, even if none of its niches are low competition
+    pools = {category: ([], []) for category in df['category'].cat.categories}
+    pools['all'] = split_by_competition(np.arange(len(records)))
+
+    for category, positions in low_comp_df.groupby('category', observed=True).indices.items():
+        pools[category] = split_by_competition(positions)
+    return pools
+
+def get_current_week():
+    """
+    Returns the current ISO week number (1-53) and the whole seconds left until that week ends.
+    The week is cached until it ends (next Monday 00:00 local time), so it never goes stale,
+    and the seconds left always belong to the returned week.
+    """
+    global current_week_cache
+    now = datetime.now()
+    week_cache = current_week_cache
+    if week_cache is None or now >= week_cache[1]:
+        week_ends_at = (now + timedelta(days=7 - now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+        week_cache = current_week_cache = (now.isocalendar()[1], week_ends_at)
+    current_week, week_ends_at = week_cache
+    return current_week, int((week_ends_at - now).total_seconds())
+
+def rotate_slice(pool, start_index, count):
+    """
+    Returns up to `count` entries of `pool` starting at `start_index`, wrapping around to the start of the list.
+    """
+    end_index = start_index + count
+    if end_index > len(pool):
+        return pool[start_index:] + pool[:end_index - len(pool)]
+    return pool[start_index:end_index]
+
+@lru_cache(maxsize=256)
+def select_weekly_niches(current_week, book_category_filter):
+    """
+    Picks this week's ~20 niches for a category: up to 15 from the ultra-low pool, the rest from the medium-low pool.
+    The result only depends on the week and category, so it is memoized; callers must not mutate the returned list.
+    """
+    # 1. Look up the precomputed, pre-sorted competition pools for this category
+    pools = niche_pools.get(book_category_filter)
+    if pools is None:
+        print(f"No data found for category: {book_category_filter}")
+        return []
+
+    ultra_low_niches, medium_low_niches = pools
+    if not ultra_low_niches and not medium_low_niches:
+        print(f"No low competition niches (<1000 results) found for category: {book_category_filter}")
+        return []
+
+    # 2. Weekly Rotation Logic
+    selected_niches = []
+    
+    # Select up to 15 from ultra-low competition (<500)
+    num_ultra_low = len(ultra_low_niches)
+    if num_ultra_low > 0:
+        start_index_ultra = ((current_week - 1) * 15) % num_ultra_low if num_ultra_low > 0 else 0
+        selected_niches.extend(rotate_slice(ultra_low_niches, start_index_ultra, 15))
+
+    # Select remaining (up to 5) from medium-low competition (500-999) to reach ~20 total
+    remaining_needed = 20 - len(selected_niches)
+    num_medium_low = len(medium_low_niches)
+
+    if remaining_needed > 0 and num_medium_low > 0:
+        start_index_medium = ((current_week - 1) * 5) % num_medium_low if num_medium_low > 0 else 0 # Different offset logic for this smaller pool
+        selected_niches.extend(rotate_slice(medium_low_niches, start_index_medium, remaining_needed))
+    
+    # Ensure we don't exceed 20 niches due to concat logic if both lists are small
+    # Pool entries are already in JSON output shape
+    return selected_niches[:20]
 
 def load_data():
     """
     Loads and preprocesses data from the CSV file.
     This function will be called once when the Flask app starts.
     """
-    global niche_data_df
+    global niche_data_df, niche_pools, data_version
+    select_weekly_niches.cache_clear() # Memoized selections are only valid for the data they were built from
     try:
         # Check if the CSV file exists
         if not os.path.exists(CSV_FILE_NAME):
             print(f"CRITICAL ERROR: CSV file '{CSV_FILE_NAME}' not found. Please upload it to the project root.")
             niche_data_df = pd.DataFrame() # Use an empty DataFrame
+            niche_pools = {}
             return
 
-        df = pd.read_csv(CSV_FILE_NAME)
-        print(f"Successfully loaded {CSV_FILE_NAME} with {len(df)} rows.")
+        csv_source_info = get_csv_source_info()
+        data_version = f"{csv_source_info['file_name']}-{csv_source_info['size']}-{csv_source_info['mtime_ns']}"
+
+        # Use the preprocessed Parquet cache if it was built from this exact CSV
+        if is_parquet_cache_fresh(csv_source_info):
+            try:
+                niche_data_df = pd.read_parquet(PARQUET_CACHE_FILE_NAME, columns=CACHE_COLUMNS)
+                print(f"Successfully loaded cached data from {PARQUET_CACHE_FILE_NAME} with {len(niche_data_df)} rows.")
+                niche_pools = build_niche_pools(niche_data_df)
+                return
+            except Exception as e:
+                print(f"Warning: Could not read data cache '{PARQUET_CACHE_FILE_NAME}', falling back to CSV: {e}")
 
-        # Ensure required columns exist
-        required_columns = ['Keyword Phrase', 'Search Volume', 'Competing Products', 'category']
-        missing_columns = [col for col in required_columns if col not in df.columns]
+        # Ensure required columns exist (reads only the header row)
+        csv_columns = pd.read_csv(CSV_FILE_NAME, nrows=0).columns
+        missing_columns = [col for col in REQUIRED_COLUMNS if col not in csv_columns]
         if missing_columns:
             print(f"CRITICAL ERROR: The CSV file is missing required columns: {', '.join(missing_columns)}")
             print("Please ensure your CSV has 'Keyword Phrase', 'Search Volume', 'Competing Products', and a 'category' column.")
             niche_data_df = pd.DataFrame()
+            niche_pools = {}
             return
 
+        # Only parse the columns we use, with the multithreaded pyarrow parser and Arrow-backed string columns.
+        # 'Search Volume' is left to type inference so exports without thousands separators parse straight to numbers
+        df = pd.read_csv(
+            CSV_FILE_NAME,
+            usecols=REQUIRED_COLUMNS,
+            dtype={col: 'string[pyarrow]' for col in STRING_COLUMNS},
+            na_values=MISSING_VALUE_MARKERS,
+            engine='pyarrow',
+            dtype_backend='pyarrow'
+        )
+        print(f"Successfully loaded {CSV_FILE_NAME} with {len(df)} rows.")
+
+        # Depending on the pandas version, the pyarrow engine ignores na_values for columns given an explicit
+        # string dtype, so mark missing values in those columns explicitly
+        for col in STRING_COLUMNS:
+            df[col] = df[col].replace(MISSING_VALUE_MARKERS, pd.NA)
+
         # Rename columns for easier use, and handle potential NaN in 'Search Volume'
         df.rename(columns={
             'Keyword Phrase': 'name',
@@ -61,21 +248,40 @@ def load_data():
             'Competing Products': 'amazon_results_raw'
         }, inplace=True)
         
-        # Clean 'amazon_results_raw' and convert to numeric 'amazon_results'
-        df['amazon_results'] = df['amazon_results_raw'].apply(parse_competing_products)
+        # Clean 'amazon_results_raw' (e.g. ">1,000" or "826") and convert to numeric 'amazon_results'
+        # Missing, 'n/a' and otherwise unparseable values become 0
+        amazon_results_clean = (
+            df['amazon_results_raw'].astype('string')
+            .str.replace(',', '', regex=False)
+            .str.replace('>', '', regex=False)
+            .str.strip()
+        )
+        df['amazon_results'] = pd.to_numeric(amazon_results_clean, errors='coerce').fillna(0).astype('int32')
+        df.drop(columns=['amazon_results_raw'], inplace=True) # Raw text is no longer needed once parsed
 
         # Convert 'search_volume_numeric' to numeric, coercing errors to NaN, then fill NaN with 0
-        df['search_volume_numeric'] = pd.to_numeric(df['search_volume_numeric'].astype(str).str.replace(',', ''), errors='coerce').fillna(0)
+        # Thousands separators only need stripping when the column was read as text (e.g. "1,768")
+        search_volume = df['search_volume_numeric']
+        if search_volume.dtype == object or pd.api.types.is_string_dtype(search_volume):
+            search_volume = search_volume.str.replace(',', '', regex=False)
+        # (cast to NumPy floats first: Arrow-backed results keep coerced NaNs distinct from nulls, so fillna would miss them)
+        df['search_volume_numeric'] = pd.to_numeric(search_volume, errors='coerce').astype('float64').fillna(0)
 
 
-        # Assign 'searchVolumeText' based on numeric 'search_volume_numeric'
-        df['searchVolumeText'] = df['search_volume_numeric'].apply(lambda x: 'High' if x > 100 else 'Low')
+        # Assign 'searchVolumeText' based on numeric 'search_volume_numeric', stored as a two-value categorical
+        df['searchVolumeText'] = pd.Categorical(np.where(df['search_volume_numeric'].to_numpy() > 100, 'High', 'Low'))
         
-        # Ensure 'category' column is treated as string
-        df['category'] = df['category'].astype(str).str.lower().str.strip()
+        # Normalise 'category' (already read as a string column)
+        df['category'] = df['category'].str.lower().str.strip()
+
+        # Downcast to compact dtypes; the low-cardinality 'category' column becomes a categorical
+        df['search_volume_numeric'] = df['search_volume_numeric'].astype('float32')
+        df['category'] = df['category'].astype('category')
 
         niche_data_df = df
+        niche_pools = build_niche_pools(df)
         print("Data loaded and preprocessed successfully.")
+        write_parquet_cache(df, csv_source_info)
         print(f"Sample of processed data:\n{niche_data_df.head()}")
         print(f"Data types:\n{niche_data_df.dtypes}")
 
@@ -83,9 +289,11 @@ def load_data():
     except FileNotFoundError:
         print(f"CRITICAL ERROR: CSV file '{CSV_FILE_NAME}' not found during load_data().")
         niche_data_df = pd.DataFrame() # Initialize with an empty DataFrame
+        niche_pools = {}
     except Exception as e:
         print(f"CRITICAL ERROR loading data: {e}")
         niche_data_df = pd.DataFrame() # Initialize with an empty DataFrame
+        niche_pools = {}
 
 # Load data when the application starts
 load_data()
@@ -98,79 +306,16 @@ def get_trends():
 
     book_category_filter = request.args.get('bookType', 'all').lower().strip()
     
-    # 1. Filter by category (if not 'all')
-    if book_category_filter != 'all':
-        filtered_df = niche_data_df[niche_data_df['category'] == book_category_filter].copy()
-    else:
-        filtered_df = niche_data_df.copy()
-
-    if filtered_df.empty:
-        print(f"No data found for category: {book_category_filter}")
-        return jsonify([])
-        
-    # 2. Filter for Amazon results < 1000
-    low_comp_df = filtered_df[filtered_df['amazon_results'] < 1000].copy()
-
-    if low_comp_df.empty:
-        print(f"No low competition niches (<1000 results) found for category: {book_category_filter}")
-        return jsonify([])
-
-    # 3. Separate into <500 results and 500-999 results
-    ultra_low_comp_df = low_comp_df[low_comp_df['amazon_results'] < 500].copy()
-    medium_low_comp_df = low_comp_df[(low_comp_df['amazon_results'] >= 500) & (low_comp_df['amazon_results'] < 1000)].copy()
+    current_week, seconds_left_in_week = get_current_week()
+    output_niches = select_weekly_niches(current_week, book_category_filter)
 
-    # Sort to try and get somewhat consistent starting points for weekly rotation
-    # Sorting by search volume descending, then by name to have a stable order
-    ultra_low_comp_df = ultra_low_comp_df.sort_values(by=['search_volume_numeric', 'name'], ascending=[False, True])
-    medium_low_comp_df = medium_low_comp_df.sort_values(by=['search_volume_numeric', 'name'], ascending=[False, True])
-
-    # 4. Weekly Rotation Logic
-    current_week = datetime.now().isocalendar()[1] # Get current week number (1-53)
-    
-    selected_niches = []
-    
-    # Select up to 15 from ultra-low competition (<500)
-    num_ultra_low = len(ultra_low_comp_df)
-    if num_ultra_low > 0:
-        start_index_ultra = ((current_week - 1) * 15) % num_ultra_low if num_ultra_low > 0 else 0
-        end_index_ultra = start_index_ultra + 15
-        
-        # Handle wrapping around the list if necessary
-        if end_index_ultra > num_ultra_low:
-            selected_ultra_low = pd.concat([ultra_low_comp_df.iloc[start_index_ultra:], ultra_low_comp_df.iloc[:end_index_ultra-num_ultra_low]])
-        else:
-            selected_ultra_low = ultra_low_comp_df.iloc[start_index_ultra:end_index_ultra]
-        selected_niches.extend(selected_ultra_low.to_dict('records'))
-
-    # Select remaining (up to 5) from medium-low competition (500-999) to reach ~20 total
-    remaining_needed = 20 - len(selected_niches)
-    num_medium_low = len(medium_low_comp_df)
-
-    if remaining_needed > 0 and num_medium_low > 0:
-        start_index_medium = ((current_week - 1) * 5) % num_medium_low if num_medium_low > 0 else 0 # Different offset logic for this smaller pool
-        end_index_medium = start_index_medium + remaining_needed
-        
-        if end_index_medium > num_medium_low:
-            selected_medium_low = pd.concat([medium_low_comp_df.iloc[start_index_medium:], medium_low_comp_df.iloc[:end_index_medium-num_medium_low]])
-        else:
-            selected_medium_low = medium_low_comp_df.iloc[start_index_medium:end_index_medium]
-        selected_niches.extend(selected_medium_low.to_dict('records'))
-    
-    # Ensure we don't exceed 20 niches due to concat logic if both lists are small
-    final_selected_niches = selected_niches[:20]
-
-    # Prepare for JSON output (select only necessary columns)
-    output_niches = []
-    for niche in final_selected_niches:
-        output_niches.append({
-            'name': niche.get('name'),
-            'searchVolumeText': niche.get('searchVolumeText'), # Already calculated
-            'amazonResults': int(niche.get('amazon_results')), # Ensure it's int
-            'category': niche.get('category')
-        })
-    
     print(f"Returning {len(output_niches)} niches for category '{book_category_filter}', week {current_week}.")
-    return jsonify(output_niches)
+    response = jsonify(output_niches)
+
+    # The response only changes with the week, category or data, so let browsers/CDNs cache it until this week ends
+    response.headers['Cache-Control'] = f'public, max-age={seconds_left_in_week}'
+    response.set_etag(hashlib.sha1(f"{data_version}-{current_week}-{book_category_filter}".encode()).hexdigest())
+    return response.make_conditional(request)
 
 @app.route('/')
 def index():
@@ -180,7 +325,8 @@ def index():
     return f"Niche Hunter Backend is running. {len(niche_data_df)} keywords loaded. Ready to serve niches from your data!"
 
 if __name__ == '__main__':
-    # This is for local development. Render uses Gunicorn specified in Procfile or Start Command.
+    # This is for local development. Render uses Gunicorn specified in Procfile or Start Command,
+    # with --preload so load_data() runs once in the master and the data is shared across workers.
     # The PORT environment variable is typically set by Render.
     port = int(os.environ.get("PORT", 5000))
-    app.run(host='0.0.0.0', port=port, debug=True) # debug=True is helpful for local dev
+    app.run(host='0.0.0.0', port=port) # No debug reloader, which would re-run load_data() on every reload